@@ -61,10 +61,13 @@ class LaionAesthetic():
         image_features = image_features.cpu().detach().numpy()
         return image_features
 
-    def get_score(self, image: Image):
-        image_features = self.get_image_features(image)
+    def get_score_from_features(self, image_features):
         score = self.predictor(torch.from_numpy(image_features).to(self.device).float())
         return score.item()
+
+    def get_score(self, image: Image):
+        image_features = self.get_image_features(image)
+        return self.get_score_from_features(image_features)
     
     def unload(self):
         del self.predictor
@@ -20,3 +20,5 @@ if os.path.isdir(f'{extensions_dir}/stable-diffusion-webui-blip2-captioner'):
 else:
     LAION_AESTHETIC_MODELS_PATH = Path(scripts.basedir(), "models")
 
+DEDUP_INDEX_PATH = Path(scripts.basedir(), "dedup")
+CHECKPOINTS_PATH = Path(scripts.basedir(), "checkpoints")
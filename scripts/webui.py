@@ -3,6 +3,7 @@ import tempfile
 from typing import Dict
 import threading
 import queue
+import numpy as np
 from PIL import Image
 import shutil
 from pathlib import Path
@@ -15,6 +16,9 @@ from modules import script_callbacks
 from tool.extractor import VideoExtractor
 from tool.interrogator import WD14Tagger, unload_wd14tagger
 from tool.predictor import LaionAestheticPredictor, unload_laion_aesthetic_predictor
+from tool.dedup import get_dedup_index, KeptFeatures
+from tool.selector import select_diverse_top_k
+from tool.checkpoint import ExtractionJob, clear_checkpoints
 from common import TaggerModelType, LaionAestheticModelType
 from extractor_utils import get_video_length, get_video_frames, write_out_frames, compress_folder
 
@@ -51,6 +55,7 @@ def on_single_video_set(video_path: str):
 def on_single_preview_btn_clicked(
         video_path: str, 
         step_of_frames: int,
+        auto_crop: bool,
     ):
     
     print("Showing preview of ", video_path)
@@ -60,7 +65,7 @@ def on_single_preview_btn_clicked(
         return ["Video file not found", None]
     
     try:
-        frames = VideoExtractor.get_frames(video_path, step_of_frames, 12)
+        frames = VideoExtractor.get_frames(video_path, step_of_frames, 12, auto_crop=auto_crop)
 
         frame_images: list[Image.Image] = []
         for frame in frames:
@@ -81,7 +86,12 @@ def on_single_extract_btn_clicked(
         ban_word_threshold: float,
         aesthetic_model_name: str,
         min_aesthetic: float,
-        max_aesthetic: float
+        max_aesthetic: float,
+        use_dedup: bool,
+        dedup_threshold: float,
+        max_frames_per_video: int,
+        diversity: float,
+        auto_crop: bool
     ):
     print("Extracting frames from ", video_path)
 
@@ -93,7 +103,26 @@ def on_single_extract_btn_clicked(
     for tag in  [tag.strip().replace(" ", "_") for tag in ban_word_text.split(",") if tag.strip() != ""]:
         ban_word_tags[tag] = ban_word_threshold 
 
+    job = None
     try:
+        # 同じ動画・同じ設定なら前回のチェックポイントから再開する
+        job = ExtractionJob(video_path, {
+            "step_of_frames": step_of_frames,
+            "tagging_model_type": tagging_model_type,
+            "ban_word_tags": ban_word_tags,
+            "aesthetic_model_name": aesthetic_model_name,
+            "min_aesthetic": min_aesthetic,
+            "max_aesthetic": max_aesthetic,
+            "use_dedup": use_dedup,
+            "dedup_threshold": dedup_threshold,
+            "auto_crop": auto_crop,
+        })
+        extracted_frames, excluded_frames, extracted_scores, extracted_features = job.load()
+        start_index = job.next_index
+
+        # 同名の別の動画と区別するため、重複判定のキーには動画の内容のハッシュを使う
+        video_key = job.fingerprint[:16]
+
         print("Extracting frames...")
 
         extracted_frames_queue = queue.Queue()
@@ -115,24 +144,55 @@ def on_single_extract_btn_clicked(
             print("Loading Laion Aesthetic Predictor...")
             predictor = LaionAestheticPredictor()
 
+            dedup_index = get_dedup_index() if use_dedup else None
+
+            # この実行で残したフレーム (再開時はチェックポイントの分も含む)
+            kept_features = KeptFeatures()
+            for features in extracted_features.values():
+                kept_features.add(features)
+
             while True:
                 idx, frame = frame_queue.get()
                 if frame is None:
                     break
 
-                aesthetic_score = predictor.predict(aesthetic_model_name, frame)
+                aesthetic_score, image_features = predictor.predict_with_features(aesthetic_model_name, frame)
 
                 print(f"Frame {idx} aesthetic score: {aesthetic_score}")
 
                 if wd14tagger.any_match(frame, ban_word_tags) or aesthetic_score < min_aesthetic or aesthetic_score > max_aesthetic:
+                    job.add(idx, frame, False, aesthetic_score)
                     excluded_frames_queue.put((idx, frame))
-                else:
-                    extracted_frames_queue.put((idx, frame))
+                    continue
+
+                if dedup_index is not None:
+                    # 同じ動画を再実行した場合に自分自身にヒットしないよう、この動画の行は除く
+                    similarity, duplicate_key = dedup_index.query(image_features, dedup_threshold, exclude_video=video_key)
+                    if similarity >= dedup_threshold:
+                        print(f"Frame {idx} is a duplicate of {duplicate_key} ({similarity:.3f})")
+                        job.add(idx, frame, False, aesthetic_score)
+                        excluded_frames_queue.put((idx, frame))
+                        continue
+
+                    similarity = kept_features.max_similarity(image_features)
+                    if similarity >= dedup_threshold:
+                        print(f"Frame {idx} is a duplicate of a frame kept in this run ({similarity:.3f})")
+                        job.add(idx, frame, False, aesthetic_score)
+                        excluded_frames_queue.put((idx, frame))
+                        continue
+                    kept_features.add(image_features)
+
+                extracted_scores[idx] = aesthetic_score
+                extracted_features[idx] = image_features
+                job.add(idx, frame, True, aesthetic_score, image_features)
+                extracted_frames_queue.put((idx, frame))
+
+            job.flush()
 
         def frame_getter():
             nonlocal num_processed_frames
 
-            frames = VideoExtractor.get_frames(video_path, step_of_frames)
+            frames = VideoExtractor.get_frames(video_path, step_of_frames, auto_crop=auto_crop, start_index=start_index)
 
             for frame, frame_index in frames:
                 if frame is None:
@@ -149,9 +209,6 @@ def on_single_extract_btn_clicked(
         frame_getter_thread = threading.Thread(target=frame_getter)
         frame_getter_thread.start()
 
-        extracted_frames = {}
-        excluded_frames = {}
-
         while not frame_getter_done.is_set() or len(extracted_frames) + len(excluded_frames) < total_frames:
             # print(f"Extracted frames: {len(extracted_frames)}")
             current_progression = (len(extracted_frames) + len(excluded_frames)) / total_frames * 100
@@ -182,6 +239,38 @@ def on_single_extract_btn_clicked(
         frame_getter_thread.join()
         processing_thread.join()
 
+        # ループを抜けた後に残っているフレームを回収する
+        while not extracted_frames_queue.empty():
+            frame_index, extracted_frame = extracted_frames_queue.get()
+            extracted_frames[frame_index] = extracted_frame
+        while not excluded_frames_queue.empty():
+            frame_index, excluded_frame = excluded_frames_queue.get()
+            excluded_frames[frame_index] = excluded_frame
+
+        if max_frames_per_video > 0 and len(extracted_frames) > max_frames_per_video:
+            print(f"Selecting {max_frames_per_video} diverse frames from {len(extracted_frames)} frames...")
+            candidates = sorted(extracted_frames)
+            selected = select_diverse_top_k(
+                np.array([extracted_scores[i] for i in candidates]),
+                np.stack([extracted_features[i] for i in candidates]),
+                int(max_frames_per_video),
+                diversity
+            )
+            selected_indices = set(candidates[i] for i in selected)
+            for i in candidates:
+                if i not in selected_indices:
+                    excluded_frames[i] = extracted_frames.pop(i)
+
+        # 最終的に残ったフレームだけを重複判定用のインデックスに登録する
+        if use_dedup:
+            dedup_index = get_dedup_index()
+            for i in sorted(extracted_frames):
+                dedup_index.add(extracted_features[i], f"{video_key}:{i}")
+            dedup_index.flush()
+
+        # 最後まで処理できたのでチェックポイントは不要
+        job.remove()
+
         extracted_frames = [extracted_frames[i] for i in sorted(extracted_frames)]
         excluded_frames = [excluded_frames[i] for i in sorted(excluded_frames)]
 
@@ -214,6 +303,11 @@ def on_single_extract_btn_clicked(
         print(e)
         return [f"Error: {e}", None, None]
 
+    finally:
+        # 失敗した場合もチェックポイントは残したまま書き出しスレッドを止める
+        if job is not None:
+            job.close()
+
 def on_single_download_extracted_btn_clicked():
     if "extracted" not in CURRENT_STATE:
         return ["No extracted frames", None]
@@ -288,6 +382,18 @@ def on_common_model_unload_btn_clicked():
     msg = "Model unloaded"
     return [msg, msg]
 
+def on_common_dedup_clear_btn_clicked():
+    get_dedup_index().clear()
+
+    msg = "Deduplication index cleared"
+    return [msg, msg]
+
+def on_common_checkpoints_clear_btn_clicked():
+    clear_checkpoints()
+
+    msg = "Checkpoints cleared"
+    return [msg, msg]
+
 def on_ui_tabs():
     with gr.Blocks(analytics_enabled=False) as ui:
         with gr.Column():
@@ -363,6 +469,12 @@ def on_ui_tabs():
                                 interactive=True
                             )
 
+                            common_auto_crop_checkbox = gr.Checkbox(
+                                label="Crop static borders (letterbox, pillarbox)",
+                                value=False,
+                                interactive=True
+                            )
+
                             common_aesthetic_model_name = gr.Dropdown(
                                 label="Aesthetic model",
                                 choices=list(AESTHETIC_MODELS.keys()),
@@ -388,6 +500,42 @@ def on_ui_tabs():
                                 interactive=True
                             )
 
+                        with gr.Row():
+                            common_dedup_checkbox = gr.Checkbox(
+                                label="Exclude frames similar to frames kept in earlier runs",
+                                value=False,
+                                interactive=True
+                            )
+                            common_dedup_threshold_slider = gr.Slider(
+                                label="Deduplication similarity threshold",
+                                minimum=0.5,
+                                maximum=1,
+                                step=0.01,
+                                value=0.95,
+                                interactive=True
+                            )
+
+                        with gr.Row():
+                            common_max_frames_per_video_slider = gr.Slider(
+                                label="Maximum frames per video (0 = unlimited)",
+                                minimum=0,
+                                maximum=500,
+                                step=1,
+                                value=0,
+                                interactive=True
+                            )
+                            common_diversity_slider = gr.Slider(
+                                label="Diversity (0 = only aesthetic score, 1 = only diversity)",
+                                minimum=0,
+                                maximum=1,
+                                step=0.05,
+                                value=0.5,
+                                interactive=True
+                            )
+
+                        common_dedup_clear_btn = gr.Button("Clear deduplication index", variant="secondary")
+                        common_checkpoints_clear_btn = gr.Button("Clear checkpoints", variant="secondary")
+
                         common_model_unload_btn = gr.Button("Unload models", variant="secondary")
 
                     with gr.Column():
@@ -405,6 +553,7 @@ def on_ui_tabs():
             inputs=[
                 single_video_input,
                 common_step_of_frames_slider,
+                common_auto_crop_checkbox,
             ],
             outputs=[
                 single_status_text,
@@ -423,6 +572,11 @@ def on_ui_tabs():
                 common_aesthetic_model_name,
                 common_min_aesthetic_score_slider,
                 common_max_aesthetic_score_slider,
+                common_dedup_checkbox,
+                common_dedup_threshold_slider,
+                common_max_frames_per_video_slider,
+                common_diversity_slider,
+                common_auto_crop_checkbox,
             ],
             outputs=[
                 single_status_text,
@@ -452,6 +606,18 @@ def on_ui_tabs():
             inputs=[],
             outputs=[single_status_text, batch_process_status_text]
         )
+
+        common_dedup_clear_btn.click(
+            fn=on_common_dedup_clear_btn_clicked,
+            inputs=[],
+            outputs=[single_status_text, batch_process_status_text]
+        )
+
+        common_checkpoints_clear_btn.click(
+            fn=on_common_checkpoints_clear_btn_clicked,
+            inputs=[],
+            outputs=[single_status_text, batch_process_status_text]
+        )
     
     return [(ui, "Video Extractor", "video_extractor")]
 
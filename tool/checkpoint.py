@@ -0,0 +1,224 @@
+from typing import Any, Dict, List, Optional, Tuple
+import os
+import json
+import shutil
+import hashlib
+import threading
+import queue
+from pathlib import Path
+import numpy as np
+from PIL import Image
+
+from common import CHECKPOINTS_PATH
+
+def get_video_fingerprint(video_path: str, chunk_size: int = 4 * 1024 * 1024) -> str:
+    # 再アップロードでパスが変わっても同じになるよう、サイズと先頭・末尾の内容から作る
+    size = os.path.getsize(video_path)
+
+    sha1 = hashlib.sha1(str(size).encode("utf-8"))
+    with open(video_path, "rb") as f:
+        sha1.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(size - chunk_size, chunk_size))
+            sha1.update(f.read(chunk_size))
+
+    return sha1.hexdigest()
+
+class ExtractionJob():
+    """
+    Resumable checkpoint of a single video extraction.
+    """
+
+    def __init__(self, video_path: str, settings: Dict[str, Any], checkpoint_interval: int = 50) -> None:
+        self.video_path = video_path
+        self.checkpoint_interval = checkpoint_interval
+        self.lock = threading.Lock()
+
+        self.fingerprint = get_video_fingerprint(video_path)
+        job_key = json.dumps({
+            "video": self.fingerprint,
+            "settings": settings,
+        }, sort_keys=True)
+        job_hash = hashlib.sha1(job_key.encode("utf-8")).hexdigest()[:12]
+
+        self.job_dir = Path(CHECKPOINTS_PATH) / job_hash
+        self.state_path = self.job_dir / "state.json"
+
+        self.next_index = 0
+        self.scores: Dict[int, float] = {}
+        self.extracted_indices: List[int] = []
+        self.excluded_indices: List[int] = []
+        self.num_feature_chunks = 0
+
+        # 一度書き出しに失敗したら、それ以降のチェックポイントは保存しない
+        self.failed = False
+        self.closed = False
+
+        # (frame index, frame, extracted, aesthetic score, features)
+        self.pending: List[Tuple[int, Image.Image, bool, float, Optional[np.ndarray]]] = []
+
+        # PNG の書き出しは重いので、分類スレッドを止めないよう別スレッドで行う
+        self.write_queue = queue.Queue()
+        self.writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self.writer_thread.start()
+
+    def load(self) -> Tuple[Dict[int, Image.Image], Dict[int, Image.Image], Dict[int, float], Dict[int, np.ndarray]]:
+        """
+        Loads the last checkpoint if exists.
+        Returns extracted frames, excluded frames, scores and features of extracted frames.
+        """
+        extracted_frames: Dict[int, Image.Image] = {}
+        excluded_frames: Dict[int, Image.Image] = {}
+        extracted_scores: Dict[int, float] = {}
+        extracted_features: Dict[int, np.ndarray] = {}
+
+        if not self.state_path.exists():
+            return extracted_frames, excluded_frames, extracted_scores, extracted_features
+
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+
+            for idx in state["extracted"]:
+                extracted_frames[idx] = self._load_image(self.job_dir / "extracted" / f"{idx}.png")
+                extracted_scores[idx] = state["scores"][str(idx)]
+            for idx in state["excluded"]:
+                excluded_frames[idx] = self._load_image(self.job_dir / "excluded" / f"{idx}.png")
+
+            for chunk in range(state["num_feature_chunks"]):
+                with np.load(self.job_dir / f"features-{chunk}.npz") as data:
+                    for idx, features in zip(data["indices"], data["features"]):
+                        extracted_features[int(idx)] = features
+
+            missing_features = [idx for idx in extracted_frames if idx not in extracted_features]
+            if len(missing_features) > 0:
+                raise ValueError(f"missing features of frames {missing_features}")
+        except Exception as e:
+            # 壊れたチェックポイントは捨てて最初からやり直す
+            print(f"Error: Discarding broken checkpoint {self.job_dir}: {e}")
+            shutil.rmtree(self.job_dir, ignore_errors=True)
+            return {}, {}, {}, {}
+
+        self.next_index = state["next_index"]
+        self.num_feature_chunks = state["num_feature_chunks"]
+        self.scores = {int(idx): score for idx, score in state["scores"].items()}
+        self.extracted_indices = state["extracted"]
+        self.excluded_indices = state["excluded"]
+
+        print(f"Resuming from frame {self.next_index} ({len(extracted_frames)} extracted, {len(excluded_frames)} excluded)")
+
+        return extracted_frames, excluded_frames, extracted_scores, extracted_features
+
+    def _load_image(self, path: Path) -> Image.Image:
+        with Image.open(path) as image:
+            image.load()
+            return image
+
+    def add(self, idx: int, frame: Image.Image, extracted: bool, score: float, features: Optional[np.ndarray] = None):
+        with self.lock:
+            self.pending.append((idx, frame, extracted, score, features))
+            if len(self.pending) < self.checkpoint_interval:
+                return
+            batch = self.pending
+            self.pending = []
+
+        self.write_queue.put(batch)
+
+    def flush(self):
+        """
+        Writes all buffered frames and waits until the checkpoint is on disk.
+        """
+        with self.lock:
+            batch = self.pending
+            self.pending = []
+
+        if len(batch) > 0:
+            self.write_queue.put(batch)
+        self.write_queue.join()
+
+    def _writer(self):
+        while True:
+            batch = self.write_queue.get()
+            try:
+                if batch is None:
+                    break
+                if not self.failed:
+                    self._write(batch)
+            except Exception as e:
+                # 途中のバッチが抜けると再開位置がずれるので、以降は保存しない
+                print(f"Error: Failed to save checkpoint, checkpointing disabled: {e}")
+                self.failed = True
+            finally:
+                self.write_queue.task_done()
+
+    def _write(self, batch: List[Tuple[int, Image.Image, bool, float, Optional[np.ndarray]]]):
+        os.makedirs(self.job_dir / "extracted", exist_ok=True)
+        os.makedirs(self.job_dir / "excluded", exist_ok=True)
+
+        # 全てのファイルを書き終えるまで自身の状態は更新しない
+        next_index = self.next_index
+        scores = dict(self.scores)
+        extracted_indices = list(self.extracted_indices)
+        excluded_indices = list(self.excluded_indices)
+        num_feature_chunks = self.num_feature_chunks
+
+        indices = []
+        features = []
+        for idx, frame, extracted, score, frame_features in batch:
+            frame.save(self.job_dir / ("extracted" if extracted else "excluded") / f"{idx}.png", compress_level=1)
+            scores[idx] = score
+            next_index = max(next_index, idx + 1)
+            if extracted:
+                extracted_indices.append(idx)
+                indices.append(idx)
+                features.append(frame_features)
+            else:
+                excluded_indices.append(idx)
+
+        if len(indices) > 0:
+            np.savez(self.job_dir / f"features-{num_feature_chunks}.npz", indices=np.array(indices), features=np.stack(features))
+            num_feature_chunks += 1
+
+        state = {
+            "next_index": next_index,
+            "num_feature_chunks": num_feature_chunks,
+            "scores": {str(idx): score for idx, score in scores.items()},
+            "extracted": extracted_indices,
+            "excluded": excluded_indices,
+        }
+
+        # 書き込み途中で落ちても壊れないように、一時ファイルに書いてから置き換える
+        tmp_path = self.job_dir / "state.tmp.json"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+        self.next_index = next_index
+        self.scores = scores
+        self.extracted_indices = extracted_indices
+        self.excluded_indices = excluded_indices
+        self.num_feature_chunks = num_feature_chunks
+
+        print(f"Checkpoint saved at frame {self.next_index}")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        # 書き出し中のチェックポイントを待ってからスレッドを止める
+        self.write_queue.put(None)
+        self.writer_thread.join()
+
+    def remove(self):
+        with self.lock:
+            self.pending = []
+
+        self.close()
+
+        if self.job_dir.exists():
+            shutil.rmtree(self.job_dir)
+
+def clear_checkpoints():
+    if Path(CHECKPOINTS_PATH).exists():
+        shutil.rmtree(CHECKPOINTS_PATH)
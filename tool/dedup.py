@@ -0,0 +1,173 @@
+from typing import Dict, List, Optional, Set, Tuple
+import os
+import shutil
+import threading
+from pathlib import Path
+import numpy as np
+
+from common import DEDUP_INDEX_PATH
+
+# CLIP ViT-L/14 の埋め込み次元
+EMBEDDING_DIM = 768
+
+class DedupIndex():
+    """
+    Persistent near-duplicate index over CLIP image embeddings.
+    """
+
+    def __init__(self, index_dir: Path = DEDUP_INDEX_PATH, dim: int = EMBEDDING_DIM, initial_capacity: int = 4096, block_size: int = 8192) -> None:
+        self.index_dir = Path(index_dir)
+        self.dim = dim
+        self.initial_capacity = initial_capacity
+        self.block_size = block_size
+        self.lock = threading.Lock()
+
+        self.embeddings_path = self.index_dir / "embeddings.npy"
+        self.keys_path = self.index_dir / "keys.txt"
+
+        self.embeddings: Optional[np.memmap] = None
+        self.keys: List[str] = []
+        self.key_set: Set[str] = set()
+        # 動画のキー -> その動画の行番号
+        self.video_rows: Dict[str, List[int]] = {}
+
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _load(self):
+        if not self.embeddings_path.exists():
+            return
+
+        self.embeddings = np.lib.format.open_memmap(self.embeddings_path, mode="r+")
+        if self.keys_path.exists():
+            with open(self.keys_path, "r", encoding="utf-8") as f:
+                # 書き込み途中で落ちた場合、改行で終わっていない最後の行は無効
+                self.keys = [line[:-1] for line in f if line.endswith("\n")]
+
+        for row, key in enumerate(self.keys):
+            self._register_key(row, key)
+
+    def _register_key(self, row: int, key: str):
+        self.key_set.add(key)
+        self.video_rows.setdefault(key.rsplit(":", 1)[0], []).append(row)
+
+    def _reserve(self, capacity: int):
+        current_capacity = 0 if self.embeddings is None else self.embeddings.shape[0]
+        if capacity <= current_capacity:
+            return
+
+        new_capacity = max(capacity, current_capacity * 2, self.initial_capacity)
+
+        if not self.index_dir.exists():
+            os.makedirs(self.index_dir)
+
+        tmp_path = self.index_dir / "embeddings.tmp.npy"
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(new_capacity, self.dim))
+
+        # ブロックごとにコピー
+        for start in range(0, len(self.keys), self.block_size):
+            end = min(start + self.block_size, len(self.keys))
+            grown[start:end] = self.embeddings[start:end]
+        grown.flush()
+
+        del grown
+        self.embeddings = None
+        os.replace(tmp_path, self.embeddings_path)
+        self.embeddings = np.lib.format.open_memmap(self.embeddings_path, mode="r+")
+
+    def query(self, features: np.ndarray, threshold: Optional[float] = None, exclude_video: Optional[str] = None) -> Tuple[float, Optional[str]]:
+        """
+        Returns the highest cosine similarity and its key, ignoring rows of exclude_video.
+        """
+        features = np.asarray(features, dtype=np.float32).reshape(-1)
+
+        best_similarity = -1.0
+        best_key = None
+
+        with self.lock:
+            excluded_rows = np.array(self.video_rows.get(exclude_video, []), dtype=np.int64)
+
+            for start in range(0, len(self.keys), self.block_size):
+                end = min(start + self.block_size, len(self.keys))
+                similarities = self.embeddings[start:end] @ features
+
+                # 同じ動画のフレームは比較しない
+                block_rows = excluded_rows[(excluded_rows >= start) & (excluded_rows < end)]
+                similarities[block_rows - start] = -np.inf
+
+                best = int(np.argmax(similarities))
+                if similarities[best] > best_similarity:
+                    best_similarity = float(similarities[best])
+                    best_key = self.keys[start + best]
+
+                if threshold is not None and best_similarity >= threshold:
+                    break
+
+        return best_similarity, best_key
+
+    def add(self, features: np.ndarray, key: str):
+        features = np.asarray(features, dtype=np.float32).reshape(-1)
+
+        with self.lock:
+            # 登録済みのキーは追加しない
+            if key in self.key_set:
+                return
+
+            self._reserve(len(self.keys) + 1)
+            self.embeddings[len(self.keys)] = features
+
+            # 行を書いてからキーを追記するので、プロセスが落ちても改行で終わるキーの数が有効な行数になる
+            with open(self.keys_path, "a", encoding="utf-8") as f:
+                f.write(key + "\n")
+            self._register_key(len(self.keys), key)
+            self.keys.append(key)
+
+    def flush(self):
+        with self.lock:
+            if self.embeddings is not None:
+                self.embeddings.flush()
+
+    def clear(self):
+        with self.lock:
+            self.embeddings = None
+            self.keys = []
+            self.key_set = set()
+            self.video_rows = {}
+            if self.index_dir.exists():
+                shutil.rmtree(self.index_dir)
+
+class KeptFeatures():
+    """
+    In-memory embeddings of frames kept so far in the current run.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM, initial_capacity: int = 256) -> None:
+        self.embeddings = np.empty((initial_capacity, dim), dtype=np.float32)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def max_similarity(self, features: np.ndarray) -> float:
+        if self.count == 0:
+            return -1.0
+        features = np.asarray(features, dtype=np.float32).reshape(-1)
+        return float((self.embeddings[:self.count] @ features).max())
+
+    def add(self, features: np.ndarray):
+        if self.count == self.embeddings.shape[0]:
+            grown = np.empty((self.count * 2, self.embeddings.shape[1]), dtype=np.float32)
+            grown[:self.count] = self.embeddings
+            self.embeddings = grown
+        self.embeddings[self.count] = np.asarray(features, dtype=np.float32).reshape(-1)
+        self.count += 1
+
+dedup_index: Optional[DedupIndex] = None
+
+def get_dedup_index() -> DedupIndex:
+    global dedup_index
+    if dedup_index is None:
+        dedup_index = DedupIndex()
+    return dedup_index
@@ -1,4 +1,6 @@
 from typing import Iterator, Optional, Tuple
+from collections import OrderedDict
+import os
 import cv2
 import numpy as np
 from PIL import Image
@@ -11,19 +13,101 @@ def frame_to_pil_image(frame: np.ndarray) -> Image.Image:
     pil_image = Image.fromarray(frame_rgb)
     return pil_image
 
+# (top, bottom, left, right)
+CropRect = Tuple[int, int, int, int]
+
+# 動画ごとのクロップ範囲のキャッシュ ((パス, サイズ, 更新日時) -> クロップ範囲)
+crop_rects: "OrderedDict[Tuple[str, int, float], Optional[CropRect]]" = OrderedDict()
+MAX_CACHED_CROP_RECTS = 32
+
+def detect_static_borders(video_path: str, num_probes: int = 8, variance_threshold: float = 25.0, flat_tolerance: float = 10.0, flat_ratio: float = 0.95, max_crop_ratio: float = 0.35) -> Optional[CropRect]:
+    """
+    Detects letterbox / pillarbox bars from a few probe frames. Returns None if nothing should be cropped.
+    """
+    cap = cv2.VideoCapture(video_path)
+
+    if not cap.isOpened():
+        print(f"Error: Could not open the video file {video_path}")
+        return None
+
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    # 動画全体から均等にプローブフレームを取る
+    probes = []
+    for position in np.linspace(frame_count * 0.05, frame_count * 0.95, num_probes).astype(int):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(position))
+        ret, frame = cap.read()
+        if ret:
+            probes.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+
+    cap.release()
+
+    if len(probes) < 2:
+        return None
+
+    stack = np.stack(probes).astype(np.float32)
+    temporal_variance = stack.var(axis=0)
+    static_rows = temporal_variance.mean(axis=1) < variance_threshold
+    static_cols = temporal_variance.mean(axis=0) < variance_threshold
+
+    # 静止した背景を切らないよう、ほぼ単色の行・列だけを帯とみなす (小さなロゴは許容する)
+    row_flatness = (np.abs(stack - np.median(stack, axis=2, keepdims=True)) <= flat_tolerance).mean(axis=2).min(axis=0)
+    col_flatness = (np.abs(stack - np.median(stack, axis=1, keepdims=True)) <= flat_tolerance).mean(axis=1).min(axis=0)
+    static_rows &= row_flatness >= flat_ratio
+    static_cols &= col_flatness >= flat_ratio
+
+    # 全体が静止している場合はクロップしない
+    if static_rows.all() or static_cols.all():
+        return None
+
+    height, width = temporal_variance.shape
+
+    def count_leading(static: np.ndarray, limit: int) -> int:
+        moving = np.flatnonzero(~static[:limit])
+        return int(moving[0]) if len(moving) > 0 else limit
+
+    top = count_leading(static_rows, int(height * max_crop_ratio))
+    bottom = height - count_leading(static_rows[::-1], int(height * max_crop_ratio))
+    left = count_leading(static_cols, int(width * max_crop_ratio))
+    right = width - count_leading(static_cols[::-1], int(width * max_crop_ratio))
+
+    if (top, bottom, left, right) == (0, height, 0, width):
+        return None
+
+    print(f"Detected static borders of {video_path}: top={top}, bottom={height - bottom}, left={left}, right={width - right}")
+    return top, bottom, left, right
+
+def get_crop_rect(video_path: str) -> Optional[CropRect]:
+    # 同じパスでもファイルが変わったら検出し直す
+    stat = os.stat(video_path)
+    key = (os.path.abspath(video_path), stat.st_size, stat.st_mtime)
+
+    if key in crop_rects:
+        crop_rects.move_to_end(key)
+        return crop_rects[key]
+
+    crop_rects[key] = detect_static_borders(video_path)
+    if len(crop_rects) > MAX_CACHED_CROP_RECTS:
+        crop_rects.popitem(last=False)
+    return crop_rects[key]
+
 class VideoExtractor():
-    def get_frames(video_path: str, frame_interval: int = 1, max_frames: Optional[int] = None,) -> Iterator[Tuple[Image.Image, int]]:        # 動画を読み込む
+    def get_frames(video_path: str, frame_interval: int = 1, max_frames: Optional[int] = None, auto_crop: bool = False, start_index: int = 0) -> Iterator[Tuple[Image.Image, int]]:
+        crop_rect = get_crop_rect(video_path) if auto_crop else None
+
+        # 動画を読み込む
         cap = cv2.VideoCapture(video_path)
 
         if not cap.isOpened():
             print(f"Error: Could not open the video file {video_path}")
             return
 
-        frame_count = 0
-        captured_frame_count = 0
+        # start_index 番目に取り出すフレームまでシークする
+        frame_count = start_index * frame_interval
+        captured_frame_count = start_index
 
-        # フレーム数を取得
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if frame_count > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count)
 
         while True:
             ret, frame = cap.read()
@@ -32,10 +116,14 @@ class VideoExtractor():
                 break
 
             if frame_count % frame_interval == 0:
+                if crop_rect is not None:
+                    top, bottom, left, right = crop_rect
+                    frame = frame[top:bottom, left:right]
+
                 yield frame_to_pil_image(frame), captured_frame_count
                 captured_frame_count += 1
 
-                if max_frames is not None and captured_frame_count >= max_frames:
+                if max_frames is not None and captured_frame_count - start_index >= max_frames:
                     break
 
             frame_count += 1
@@ -1,4 +1,5 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple
+import numpy as np
 from PIL import Image
 
 from aesthetic.laion import LaionAesthetic
@@ -13,6 +14,10 @@ class Predictor():
 
     def predict(self, image_path: str) -> List[float]:
         return self.predictor.get_score(image_path)
+
+    def predict_with_features(self, image: Image) -> Tuple[float, np.ndarray]:
+        image_features = self.predictor.get_image_features(image)
+        return self.predictor.get_score_from_features(image_features), image_features[0]
     
     def unload(self):
         self.predictor.unload()
@@ -31,6 +36,9 @@ class LaionAestheticPredictor():
     def predict(self, model_name: LaionAestheticModelType, image: Image) -> float:
         return predictors[model_name].predict(image)
 
+    def predict_with_features(self, model_name: LaionAestheticModelType, image: Image) -> Tuple[float, np.ndarray]:
+        return predictors[model_name].predict_with_features(image)
+
 def unload_laion_aesthetic_predictor():
     global predictors
     for predictor in predictors.values():
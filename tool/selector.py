@@ -0,0 +1,43 @@
+from typing import List
+import numpy as np
+
+def select_diverse_top_k(scores: np.ndarray, features: np.ndarray, k: int, diversity: float = 0.5) -> List[int]:
+    """
+    Greedy maximal marginal relevance (MMR) selection.
+
+    Picks up to k rows maximizing (1 - diversity) * normalized score - diversity * max cosine
+    similarity to the already selected rows. features must be L2-normalized.
+    Returns the selected row positions in the order they were picked.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    features = np.asarray(features, dtype=np.float32)
+
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return []
+    if n <= k:
+        return [int(i) for i in np.argsort(-scores)]
+
+    # スコアを 0 ~ 1 に正規化して類似度とスケールを揃える
+    score_range = scores.max() - scores.min()
+    relevance = (scores - scores.min()) / score_range if score_range > 0 else np.zeros_like(scores)
+
+    max_similarity = np.full(n, -1.0, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    selected: List[int] = []
+
+    for _ in range(k):
+        if len(selected) == 0:
+            mmr = relevance.copy()
+        else:
+            mmr = (1 - diversity) * relevance - diversity * max_similarity
+        mmr[~available] = -np.inf
+
+        picked = int(np.argmax(mmr))
+        selected.append(picked)
+        available[picked] = False
+
+        # 選んだ行との類似度で最大類似度を更新
+        np.maximum(max_similarity, features @ features[picked], out=max_similarity)
+
+    return selected